@@ -2,6 +2,7 @@ import argparse
 import multiprocessing
 
 from rgb_recorder.recording.record import record_videos
+from rgb_recorder.recording.zed_multiprocessing import limit_worker_threads
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -12,11 +13,15 @@ if __name__ == "__main__":
     parser.add_argument("--resolution",
                         help="Supported resolutions: [(2208, 1242), (1920, 1080), (1280, 720), (672, 376)]", nargs=2,
                         type=int, default=[2208, 1242])
+    parser.add_argument("--hardware-encoding",
+                        help="Encode the videos with a VAAPI or Quick Sync (Intel/AMD GPU) H.264 encoder, if available",
+                        action="store_true")
 
     args = parser.parse_args()
 
     multiprocessing.set_start_method("spawn")
+    limit_worker_threads()  # Before spawning any processes, so that they inherit the environment variables.
 
     resolution = tuple(args.resolution)
 
-    record_videos(args.serial_numbers, args.output_dir, args.fps, resolution)
+    record_videos(args.serial_numbers, args.output_dir, args.fps, resolution, args.hardware_encoding)
@@ -0,0 +1,120 @@
+"""Shared memory blocks that are backed by huge pages, for the large (image) blocks.
+
+Regular shared memory lives on /dev/shm, which uses 4 KiB pages: a single 2K image spans thousands of pages, and every
+copy into or out of it takes a TLB miss at every page boundary. Files on a hugetlbfs mount are backed by 2 MiB pages
+instead. Huge pages must be reserved by the system administrator, e.g.:
+    echo 64 | sudo tee /proc/sys/vm/nr_hugepages
+When no huge pages are reserved, we fall back to regular shared memory.
+"""
+
+import mmap
+import os
+from multiprocessing import shared_memory
+from typing import Tuple, Union
+
+import numpy as np
+from airo_camera_toolkit.cameras.multiprocess.multiprocess_rgb_camera import shared_memory_block_like
+from loguru import logger
+
+_HUGETLBFS_MOUNT = "/dev/hugepages"
+_NR_HUGEPAGES_PATH = "/proc/sys/vm/nr_hugepages"
+_HUGE_PAGE_SIZE = 2 * 1024 * 1024  # The default huge page size on x86-64.
+
+
+def huge_pages_available() -> bool:
+    """Whether huge pages have been reserved and hugetlbfs is mounted."""
+    try:
+        with open(_NR_HUGEPAGES_PATH) as f:
+            nr_hugepages = int(f.read())
+    except (OSError, ValueError):
+        return False
+    return nr_hugepages > 0 and os.path.ismount(_HUGETLBFS_MOUNT)
+
+
+class HugePageSharedMemory:
+    """A minimal stand-in for multiprocessing.shared_memory.SharedMemory that is backed by a file on hugetlbfs.
+
+    It supports the parts of the SharedMemory interface that we use: name, size, buf, close() and unlink().
+    """
+
+    def __init__(self, name: str, create: bool = False, size: int = 0) -> None:
+        self._name = name
+        self._path = os.path.join(_HUGETLBFS_MOUNT, name)
+
+        if create:
+            # Files on hugetlbfs can only be sized in multiples of the huge page size.
+            size = -(-size // _HUGE_PAGE_SIZE) * _HUGE_PAGE_SIZE
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        else:
+            fd = os.open(self._path, os.O_RDWR)
+            size = os.fstat(fd).st_size
+
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+        except OSError:
+            # E.g. when there are not enough free huge pages left.
+            if create:
+                os.unlink(self._path)
+            raise
+        finally:
+            os.close(fd)
+
+        self._size = size
+        self._buf: memoryview | None = memoryview(self._mmap)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def buf(self) -> memoryview:
+        return self._buf
+
+    def close(self) -> None:
+        if self._buf is not None:
+            self._buf.release()
+            self._buf = None
+            self._mmap.close()
+
+    def unlink(self) -> None:
+        os.unlink(self._path)
+
+
+SharedMemoryBlock = Union[shared_memory.SharedMemory, HugePageSharedMemory]
+
+
+def huge_page_block_like(array: np.ndarray, name: str) -> Tuple[SharedMemoryBlock, np.ndarray]:
+    """Like shared_memory_block_like, but the block is backed by huge pages when they are available.
+
+    A stale hugetlbfs file with the same name (e.g. left behind by a publisher that crashed) is removed first, whether
+    or not we use huge pages now. Otherwise, receivers would attach to that file instead of to the new block."""
+    try:
+        os.unlink(os.path.join(_HUGETLBFS_MOUNT, name))
+    except FileNotFoundError:
+        pass
+
+    if huge_pages_available():
+        try:
+            shm = HugePageSharedMemory(name, create=True, size=array.nbytes)
+        except FileExistsError:
+            raise  # Another process created the block in the meantime, falling back would not help.
+        except OSError as e:
+            logger.warning(f"Could not allocate huge pages for {name}, falling back to regular shared memory: {e}")
+        else:
+            shm_array: np.ndarray = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shm_array[:] = array[:]
+            return shm, shm_array
+    return shared_memory_block_like(array, name)
+
+
+def attach_huge_page_block(name: str) -> SharedMemoryBlock:
+    """Attaches to a block that was created with huge_page_block_like, whichever memory it ended up in."""
+    if os.path.exists(os.path.join(_HUGETLBFS_MOUNT, name)):
+        return HugePageSharedMemory(name)
+    return shared_memory.SharedMemory(name=name)
@@ -1,7 +1,8 @@
 import datetime
+import multiprocessing
 import os
 from multiprocessing import Barrier
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 from airo_camera_toolkit.cameras.zed.zed import Zed
 from pyzed import sl
@@ -9,27 +10,60 @@ from pyzed import sl
 from rgb_recorder.recording.video_recorder import MultiprocessVideoRecorder
 from rgb_recorder.recording.zed_multiprocessing import ZedPublisher
 
+# Publishers are forked from a fork server that imports these modules once, instead of every publisher importing them
+# again in a freshly spawned interpreter. Importing them does not initialize CUDA, so the fork server stays safe to
+# fork.
+_PUBLISHER_PRELOAD_MODULES = [
+    "numpy",
+    "cv2",
+    "pyzed.sl",
+    "airo_camera_toolkit.cameras.zed.zed",
+    "rgb_recorder.recording.zed_multiprocessing",
+]
 
-def create_output_directory(output_dir: str) -> str:
-    output_dir = output_dir
-    os.makedirs(output_dir, exist_ok=True)
+
+def create_output_paths(output_dir: str, serial_numbers: List[str]) -> Dict[str, str]:
+    """Creates an output directory for every camera and returns the path of every camera's color video.
+
+    The timestamp is determined once, so that the videos of all cameras end up in the same recording directory.
+    A camera's directory must not exist yet: that would mean that another recording was started in the same second,
+    and we would overwrite its videos."""
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d/%H-%M-%S")
-    video_name = f"{timestamp}/color.mp4"
-    video_path = os.path.join(output_dir, video_name)
-    return video_path
+    recording_dir = os.path.abspath(os.path.join(output_dir, timestamp))
+    os.makedirs(recording_dir, exist_ok=True)
+    video_paths = {}
+    for serial_number in serial_numbers:
+        video_dir = os.path.join(recording_dir, serial_number)
+        os.makedirs(video_dir, exist_ok=False)
+        video_paths[serial_number] = os.path.join(video_dir, "color.mp4")
+    return video_paths
+
+
+def assign_cpu_cores(serial_numbers: List[str]) -> Optional[Dict[str, Tuple[int, int]]]:
+    """Assigns two neighbouring CPU cores to every camera: one for its publisher's publishing thread and one for its
+    recorder's main thread. The publisher's grab thread, the Zed SDK's threads and the video encoder threads are not
+    pinned, so they can run on other cores.
+
+    Neighbouring cores typically share (at least) the last level cache, so frames written by the publisher are still
+    cached when the recorder reads them. Returns None if there are not enough cores to give every thread its own."""
+    cpu_cores = sorted(os.sched_getaffinity(0))
+    if len(cpu_cores) < 2 * len(serial_numbers):
+        return None
+    return {serial_number: (cpu_cores[2 * i], cpu_cores[2 * i + 1]) for i, serial_number in enumerate(serial_numbers)}
 
 
 def record_videos(serial_numbers: List[str], output_dir: str, fps: int,
-                  resolution: tuple[int, int]) -> None:
-    publishers = create_publishers(fps, resolution, serial_numbers)
-    start_publishers(publishers)
+                  resolution: tuple[int, int], hardware_encoding: bool = False) -> None:
+    cpu_cores = assign_cpu_cores(serial_numbers)
+    video_paths = create_output_paths(output_dir, serial_numbers)
 
-    video_path = create_output_file(output_dir)
+    publishers = create_publishers(fps, resolution, serial_numbers, cpu_cores)
+    start_publishers(publishers)
 
     # Barrier to synchronize recording start.
     barrier = Barrier(len(serial_numbers) + 1)  # One per camera, plus one for this process.
 
-    recorders = create_recorders(barrier, serial_numbers, video_path)
+    recorders = create_recorders(barrier, serial_numbers, video_paths, cpu_cores, hardware_encoding)
     start_recorders(recorders)
 
     read_user_input(barrier)
@@ -39,9 +73,12 @@ def record_videos(serial_numbers: List[str], output_dir: str, fps: int,
 
 
 def shutdown_publishers(publishers):
-    # Stop the camera publishers.
+    # Stop the camera publishers. Wait for them to finish, because they remove their shared memory blocks, semaphores
+    # and sockets by name, which would otherwise race with the publishers of a new session in the same namespaces.
     for publisher in publishers:
         publisher.stop()
+    for publisher in publishers:
+        publisher.join()
 
 
 def shutdown_recorders(recorders):
@@ -74,13 +111,15 @@ def start_recorders(recorders):
         recorder.start()
 
 
-def create_recorders(barrier, serial_numbers, video_path):
+def create_recorders(barrier, serial_numbers, video_paths, cpu_cores=None, hardware_encoding=False):
     # Initialize the camera subscribers (video recorders).
     recorders = []
     for serial_number in serial_numbers:
         recorder = MultiprocessVideoRecorder(serial_number,
-                                             video_path.replace("color.mp4", f"{serial_number}/color.mp4"),
-                                             multi_recorder_barrier=barrier)
+                                             video_paths[serial_number],
+                                             multi_recorder_barrier=barrier,
+                                             cpu_core=cpu_cores[serial_number][1] if cpu_cores else None,
+                                             hardware_encoding=hardware_encoding)
         recorders.append(recorder)
     return recorders
 
@@ -91,7 +130,10 @@ def start_publishers(publishers):
         publisher.start()
 
 
-def create_publishers(fps, resolution, serial_numbers):
+def create_publishers(fps, resolution, serial_numbers, cpu_cores=None):
+    # The preload only takes effect if the fork server has not been started yet, i.e. before the first publisher starts.
+    multiprocessing.get_context("forkserver").set_forkserver_preload(_PUBLISHER_PRELOAD_MODULES)
+
     # Initialize the camera publishers.
     publishers = []
     for serial_number in serial_numbers:
@@ -99,6 +141,7 @@ def create_publishers(fps, resolution, serial_numbers):
                                                          serial_number=serial_number,
                                                          fps=fps,
                                                          depth_mode=sl.DEPTH_MODE.NONE),
-                                 shared_memory_namespace=serial_number)
+                                 shared_memory_namespace=serial_number,
+                                 cpu_core=cpu_cores[serial_number][0] if cpu_cores else None)
         publishers.append(publisher)
     return publishers
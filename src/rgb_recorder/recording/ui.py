@@ -5,9 +5,10 @@ import tkinter as tk
 from multiprocessing import Barrier
 from tkinter import messagebox
 
-from rgb_recorder.recording.record import create_publishers, start_publishers, create_output_file, \
+from rgb_recorder.recording.record import create_publishers, start_publishers, create_output_paths, \
     create_recorders, \
-    start_recorders, shutdown_publishers, shutdown_recorders
+    start_recorders, shutdown_publishers, shutdown_recorders, assign_cpu_cores
+from rgb_recorder.recording.zed_multiprocessing import limit_worker_threads
 
 config = configparser.ConfigParser()
 config_file = os.path.join(os.getcwd(), "rgb_recorder_config.ini")
@@ -19,6 +20,7 @@ def load_config():
         output_dir_entry.insert(0, config.get('Settings', 'output_dir', fallback='output'))
         fps_entry.insert(0, config.get('Settings', 'fps', fallback='60'))
         resolution_var.set(config.get('Settings', 'resolution', fallback='1280 720'))
+        hardware_encoding_var.set(config.getboolean('Settings', 'hardware_encoding', fallback=False))
 
 
 def save_config():
@@ -26,7 +28,8 @@ def save_config():
         'serial_numbers': serial_numbers_entry.get(),
         'output_dir': output_dir_entry.get(),
         'fps': fps_entry.get(),
-        'resolution': resolution_var.get()
+        'resolution': resolution_var.get(),
+        'hardware_encoding': str(hardware_encoding_var.get())
     }
     with open(config_file, 'w') as configfile:
         config.write(configfile)
@@ -50,20 +53,22 @@ def start():
     output_dir = output_dir_entry.get()
     fps = int(fps_entry.get())
     resolution = tuple(int(x) for x in resolution_var.get().split(' '))
+    hardware_encoding = hardware_encoding_var.get()
 
     if not serial_numbers:
         messagebox.showerror("Error", "Serial numbers are required.")
         return
 
-    publishers = create_publishers(fps, resolution, serial_numbers)
-    start_publishers(publishers)
+    cpu_cores = assign_cpu_cores(serial_numbers)
+    video_paths = create_output_paths(output_dir, serial_numbers)
 
-    video_path = create_output_file(output_dir)
+    publishers = create_publishers(fps, resolution, serial_numbers, cpu_cores)
+    start_publishers(publishers)
 
     # Barrier to synchronize recording start.
     barrier = Barrier(len(serial_numbers))  # One per camera, plus one for this process.
 
-    recorders = create_recorders(barrier, serial_numbers, video_path)
+    recorders = create_recorders(barrier, serial_numbers, video_paths, cpu_cores, hardware_encoding)
     start_recorders(recorders)
 
     # Disable start_button, enable stop_button
@@ -96,6 +101,7 @@ def stop():
 
 if __name__ == '__main__':
     multiprocessing.set_start_method('spawn')
+    limit_worker_threads()  # Before spawning any processes, so that they inherit the environment variables.
 
     app = tk.Tk()
     app.title("RGB Recorder")
@@ -117,14 +123,17 @@ if __name__ == '__main__':
     resolution_entry = tk.Entry(app, textvariable=resolution_var, width=50)
     resolution_entry.grid(row=4, column=1)
 
+    hardware_encoding_var = tk.BooleanVar(value=False)
+    tk.Checkbutton(app, text="Hardware encoding", variable=hardware_encoding_var).grid(row=5, column=1, sticky=tk.W)
+
     start_button = tk.Button(app, text="Start", command=start)
-    start_button.grid(row=5, column=0, columnspan=1)
+    start_button.grid(row=6, column=0, columnspan=1)
     stop_button = tk.Button(app, text="Stop", command=stop)
-    stop_button.grid(row=5, column=1, columnspan=1)
+    stop_button.grid(row=6, column=1, columnspan=1)
     stop_button.config(state=tk.DISABLED)
 
     status_label = tk.Label(app, text="")
-    status_label.grid(row=6, column=0, columnspan=2)
+    status_label.grid(row=7, column=0, columnspan=2)
 
     load_config()
     app.mainloop()
@@ -1,13 +1,13 @@
 import multiprocessing
-import os
-import time
 from multiprocessing import Process
-from typing import Optional
+from typing import Optional, Tuple
 
 import cv2
 from loguru import logger
 
-from rgb_recorder.recording.zed_multiprocessing import ZedReceiver
+from rgb_recorder.recording.zed_multiprocessing import ZedReceiver, limit_worker_threads, pin_to_cpu_core
+
+_SHUTDOWN_POLL_PERIOD = 0.1  # Maximum time (in seconds) between two checks of the shutdown event.
 
 
 class MultiprocessVideoRecorder(Process):
@@ -19,12 +19,16 @@ class MultiprocessVideoRecorder(Process):
             video_path: str,
             fill_missing_frames: bool = True,
             multi_recorder_barrier: Optional[multiprocessing.Barrier] = None,
+            cpu_core: Optional[int] = None,
+            hardware_encoding: bool = False,
     ):
         super().__init__(daemon=True)
         self._shared_memory_namespace = shared_memory_namespace
         self.shutdown_event = multiprocessing.Event()
         self.fill_missing_frames = fill_missing_frames
         self._multi_recorder_barrier = multi_recorder_barrier
+        self._cpu_core = cpu_core
+        self._hardware_encoding = hardware_encoding
 
         self._video_path_left = video_path.replace(".mp4", "_left.mp4")
         self._video_path_right = video_path.replace(".mp4", "_right.mp4")
@@ -32,65 +36,95 @@ class MultiprocessVideoRecorder(Process):
     def start(self) -> None:
         super().start()
 
+    def _create_video_writer(self, video_path: str, fps: float, frame_size: Tuple[int, int]) -> cv2.VideoWriter:
+        """Creates a video writer. With hardware_encoding, we ask OpenCV's FFmpeg backend for a hardware accelerated
+        H.264 encoder, which takes the encoding work off the CPU. Note that OpenCV only uses VAAPI and Intel Media SDK
+        (Quick Sync) encoders, so this needs an Intel or AMD GPU: NVIDIA's NVENC is never used.
+
+        With VIDEO_ACCELERATION_ANY, OpenCV silently falls back to a software H.264 encoder if no hardware encoder is
+        available. That costs a lot more CPU time than the default MPEG-4 encoder, which is the opposite of what we
+        want, so we ask the writer which encoder it ended up with and use the MPEG-4 encoder unless it is hardware."""
+        if self._hardware_encoding:
+            fourcc = cv2.VideoWriter_fourcc(*'avc1')
+            params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+            video_writer = cv2.VideoWriter(video_path, cv2.CAP_FFMPEG, fourcc, fps, frame_size, params)
+            if video_writer.isOpened():
+                acceleration = int(video_writer.get(cv2.VIDEOWRITER_PROP_HW_ACCELERATION))
+                if acceleration != cv2.VIDEO_ACCELERATION_NONE:
+                    logger.info(f"Encoding {video_path} with hardware acceleration (type {acceleration}).")
+                    return video_writer
+                video_writer.release()
+            logger.warning(f"No VAAPI or Quick Sync H.264 encoder available, encoding {video_path} with MPEG-4.")
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        return cv2.VideoWriter(video_path, fourcc, fps, frame_size)
+
     def run(self) -> None:
+        limit_worker_threads()
+
         if self._multi_recorder_barrier is not None:
             logger.info("Waiting for barrier")
             self._multi_recorder_barrier.wait()
             logger.info("Barrier released")
 
-        os.makedirs(os.path.dirname(self._video_path_left), exist_ok=False)
-
         receiver = ZedReceiver(self._shared_memory_namespace)
-        camera_fps = receiver.fps_shm_array[0]
-        camera_period = 1 / camera_fps
+        camera_fps = receiver.fps
+        camera_period_ns = 1e9 / camera_fps  # Timestamps are in nanoseconds.
 
-        height, width, _ = receiver.rgb_left_shm_array.shape
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        video_writer_left = cv2.VideoWriter(self._video_path_left, fourcc, camera_fps, (width, height))
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        video_writer_right = cv2.VideoWriter(self._video_path_right, fourcc, camera_fps, (width, height))
+        video_writer_left = self._create_video_writer(self._video_path_left, camera_fps, receiver.resolution)
+        video_writer_right = self._create_video_writer(self._video_path_right, camera_fps, receiver.resolution)
+
+        # Only pin the recording thread, now that the encoder threads of the video writers have been started (they would
+        # inherit the affinity). Otherwise the encoders of both streams would have to share a single core.
+        if self._cpu_core is not None:
+            pin_to_cpu_core(self._cpu_core)
 
         logger.info(f"Recording videos to {self._video_path_left} and {self._video_path_right}")
 
-        image_previous_left, image_previous_right = receiver.get_rgb_image_as_int()
-        timestamp_prev_frame = receiver.get_current_timestamp()
-        video_writer_left.write(cv2.cvtColor(image_previous_left, cv2.COLOR_RGB2BGR))
-        video_writer_right.write(cv2.cvtColor(image_previous_right, cv2.COLOR_RGB2BGR))
+        receiver.wait_for_frame()
+        image_previous_left, image_previous_right = receiver.retrieve_bgr_images()
+        timestamp_prev_frame = receiver.retrieved_timestamp
+        # The video writers expect BGR images, which is how the publisher stores them, so no conversion is needed.
+        video_writer_left.write(image_previous_left)
+        video_writer_right.write(image_previous_right)
         n_consecutive_frames_dropped = 0
 
         while not self.shutdown_event.is_set():
-            timestamp_receiver = receiver.get_current_timestamp()
-
+            # Block until a new frame arrives, but wake up regularly to check for the shutdown event.
+            n_frames_published = receiver.wait_for_frame(timeout=_SHUTDOWN_POLL_PERIOD)
+            if n_frames_published == 0:
+                continue
+            if n_frames_published > 1:
+                # Unlike the frames the camera drops (detected below), these frames were published, but we were too
+                # slow to read them before they were overwritten.
+                logger.warning(f"Recorder fell behind, {n_frames_published - 1} published frames were overwritten.")
+
+            # The timestamp is read together with the slot that holds the images, so they always belong together.
+            # Retrieving the same frame again does not release the previous images, as they are in the same slot.
+            image_new_left, image_new_right = receiver.retrieve_bgr_images()
+            timestamp_receiver = receiver.retrieved_timestamp
             if timestamp_receiver <= timestamp_prev_frame:
-                time.sleep(0.00001)  # Prevent busy waiting
                 continue
 
-            # New frame arrived
-            image_rgb_new_left, image_rgb_new_right = receiver._retrieve_rgb_image_as_int()
-
+            # New frame arrived. We fill the missed frames before writing it. The receiver keeps holding the previous
+            # images (until the next retrieve), so they are still valid here.
             timestamp_difference = timestamp_receiver - timestamp_prev_frame
-            missed_frames = int(timestamp_difference / camera_period) - 1
+            missed_frames = int(timestamp_difference / camera_period_ns) - 1
 
             if missed_frames > 0:
                 logger.warning(f"Missed {missed_frames} frames (fill_missing_frames = {self.fill_missing_frames}).")
 
                 if self.fill_missing_frames:
-                    image_fill_left = cv2.cvtColor(image_previous_left, cv2.COLOR_RGB2BGR)
-                    image_fill_right = cv2.cvtColor(image_previous_right, cv2.COLOR_RGB2BGR)
                     for _ in range(missed_frames):
-                        video_writer_left.write(image_fill_left)
-                        video_writer_right.write(image_fill_right)
+                        video_writer_left.write(image_previous_left)
+                        video_writer_right.write(image_previous_right)
                         n_consecutive_frames_dropped += 1
 
             timestamp_prev_frame = timestamp_receiver
-            image_previous_left = image_rgb_new_left
-            image_previous_right = image_rgb_new_right
-
-            image_left = cv2.cvtColor(image_rgb_new_left, cv2.COLOR_RGB2BGR)
-            image_right = cv2.cvtColor(image_rgb_new_right, cv2.COLOR_RGB2BGR)
+            image_previous_left = image_new_left
+            image_previous_right = image_new_right
 
-            video_writer_left.write(image_left)
-            video_writer_right.write(image_right)
+            video_writer_left.write(image_new_left)
+            video_writer_right.write(image_new_right)
 
         logger.info("Video recorder has detected shutdown event. Releasing video_writer_[left,right].")
         video_writer_left.release()
@@ -3,31 +3,132 @@ It explicitly checks whether a Zed camera was instantiated and supports reading
 of the camera."""
 
 import multiprocessing
+import os
+import select
+import signal
+import tempfile
+import threading
 from multiprocessing import resource_tracker
 import time
 from multiprocessing import shared_memory
-from typing import Optional, Tuple
+from multiprocessing.connection import Client, Listener
+from multiprocessing.reduction import recv_handle, send_handle
+from types import FrameType
+from typing import Dict, List, Optional, Tuple
 
+import cv2
 import numpy as np
+import posix_ipc
 from airo_camera_toolkit.cameras.multiprocess.multiprocess_rgb_camera import shared_memory_block_like
 from airo_camera_toolkit.cameras.zed.zed import Zed
-from airo_camera_toolkit.interfaces import RGBCamera, StereoRGBDCamera
+from airo_camera_toolkit.interfaces import RGBCamera
 from airo_camera_toolkit.utils.image_converter import ImageConverter
 from airo_typing import CameraResolutionType, NumpyFloatImageType, NumpyIntImageType, CameraIntrinsicsMatrixType
 from loguru import logger
+from pyzed import sl
 
-_RGB_LEFT_SHM_NAME = "rgb_left"
-_RGB_RIGHT_SHM_NAME = "rgb_right"
-_RGB_SHAPE_SHM_NAME = "rgb_shape"
-_TIMESTAMP_SHM_NAME = "timestamp"
-_INTRINSICS_SHM_NAME = "intrinsics"
-_FPS_SHM_NAME = "fps"
-# We use this flag as a lock (we can't use built-in events/locks because they need to be passed explicitly to the receivers.)
-_WRITE_LOCK_SHM_NAME = "write_lock"  # Boolean: only one writer allowed at a time.
-_READ_LOCK_SHM_NAME = "read_lock"  # int: number of readers currently reading.
+from rgb_recorder.recording.huge_page_memory import SharedMemoryBlock, attach_huge_page_block, huge_page_block_like
 
+_RGB_SHM_NAME = "rgb"  # The left and right images side by side.
+# uint64: the timestamp of the latest frame and the slot that holds it, see pack_published_frame().
+_PUBLISHED_FRAME_SHM_NAME = "published_frame"
+# int[2]: the slots that the receiver holds, the one it retrieved last and the one before that (-1 if none).
+_READER_INDEX_SHM_NAME = "reader_index"
+_SHM_NAMES = (_RGB_SHM_NAME, _PUBLISHED_FRAME_SHM_NAME, _READER_INDEX_SHM_NAME)
+# The publisher always has a free slot to write into, even while the receiver holds two slots (the recorder writes the
+# previous frame again for missed frames after retrieving the new one) and another slot holds the latest frame.
+_N_RGB_SLOTS = 4
+_N_READER_SLOTS = 2
+_SLOT_INDEX_BITS = 2  # Enough for _N_RGB_SLOTS, and leaves 62 bits (146 years) for the timestamp.
+_SLOT_INDEX_MASK = (1 << _SLOT_INDEX_BITS) - 1
+# We use a named POSIX semaphore for mutual exclusion (we can't use built-in locks because they need to be passed
+# explicitly to the receivers, whereas named semaphores can be opened by name, just like the shared memory blocks.)
+_FRAME_LOCK_SEM_NAME = "frame_lock"  # Binary semaphore: held while a frame is being written or read.
+# Inside the publisher, a grab thread retrieves frames into one matrix while the main thread publishes the other.
+_N_STAGING_MATS = 2
+_HANDOFF_POLL_PERIOD = 0.1  # Seconds, the main thread waits for frames in steps this long to keep handling SIGTERM.
+_GRAB_THREAD_JOIN_TIMEOUT = 1.0  # Seconds, a grab should never take this long.
+# These size the thread pools of the OpenMP/BLAS libraries that numpy and OpenCV are built against.
+_THREAD_POOL_ENVIRONMENT_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+# Publishers are forked from a fork server, see create_publishers() for the modules that it preloads.
+_forkserver_context = multiprocessing.get_context("forkserver")
 
-class ZedPublisher(multiprocessing.context.SpawnProcess):
+
+def shared_memory_name(shared_memory_namespace: str, name: str) -> str:
+    return f"{shared_memory_namespace}_{name}"
+
+
+def is_huge_page_block(name: str) -> bool:
+    """Only the large rgb block is worth backing with huge pages, the others fit in a single regular page."""
+    return name == _RGB_SHM_NAME
+
+
+def camera_info_address(shared_memory_namespace: str) -> str:
+    """The UNIX socket on which the publisher hands out the camera information that does not change over time."""
+    return os.path.join(tempfile.gettempdir(), f"{shared_memory_namespace}_camera_info.sock")
+
+
+def pin_to_cpu_core(cpu_core: int) -> None:
+    """Pins the calling thread to a single CPU core, so that the scheduler does not migrate it away from the caches
+    that hold its frames.
+
+    On Linux, the affinity mask belongs to a thread, not to the whole process. Threads that are started afterwards
+    inherit it, threads that are already running keep their own."""
+    os.sched_setaffinity(0, {cpu_core})
+    logger.info(f"Pinned thread {threading.get_native_id()} of process {os.getpid()} to CPU core {cpu_core}.")
+
+
+def limit_worker_threads() -> None:
+    """Our processes only copy and convert images, so they don't benefit from OpenCV's and BLAS' worker threads. With
+    a publisher and a recorder per camera, each with their own thread pools, the pools would only oversubscribe the
+    cores.
+
+    The BLAS thread pools are sized when numpy is imported, so the environment variables only affect processes that
+    are started afterwards. Call this function in the main process before starting publishers and recorders, and in
+    those processes themselves for OpenCV."""
+    for name in _THREAD_POOL_ENVIRONMENT_VARIABLES:
+        os.environ[name] = "1"
+    cv2.setNumThreads(0)
+
+
+def pack_published_frame(timestamp: int, slot_index: int) -> int:
+    """Packs the time.monotonic_ns() timestamp of a frame and the slot that holds it into a single 64-bit value.
+
+    This way they are written and read with a single aligned 8 byte store and load, which is atomic on x86-64, so a
+    receiver never sees the timestamp of one frame together with the slot of another."""
+    return (timestamp << _SLOT_INDEX_BITS) | slot_index
+
+
+def unpack_published_frame(published_frame: int) -> Tuple[int, int]:
+    """The inverse of pack_published_frame, returns the timestamp and the slot index."""
+    return published_frame >> _SLOT_INDEX_BITS, published_frame & _SLOT_INDEX_MASK
+
+
+def semaphore_name(shared_memory_namespace: str, name: str) -> str:
+    """POSIX semaphore names must start with a slash."""
+    return f"/{shared_memory_namespace}_{name}"
+
+
+def create_semaphore(name: str, initial_value: int) -> posix_ipc.Semaphore:
+    """Creates a named semaphore. A stale semaphore with the same name (e.g. left behind by a publisher that crashed)
+    is removed first, because its value would otherwise be reused instead of initial_value."""
+    try:
+        posix_ipc.unlink_semaphore(name)
+    except posix_ipc.ExistentialError:
+        pass
+    return posix_ipc.Semaphore(name, posix_ipc.O_CREX, initial_value=initial_value)
+
+
+def close_block(name: str, shm: SharedMemoryBlock) -> None:
+    """Closes a shared memory block. A block can't be closed while numpy arrays on it are still alive somewhere
+    (BufferError), in that case its memory is only released when the process exits, so we just warn about it."""
+    try:
+        shm.close()
+    except BufferError as e:
+        logger.warning(f"Could not close shared memory block {name}, it is still in use: {e}")
+
+
+class ZedPublisher(multiprocessing.context.ForkServerProcess):
     """Publishes the data of a camera that implements the RGBCamera interface to shared memory blocks.
     Shared memory blocks can then be accessed in other processes using their names,
     cf. https://docs.python.org/3/library/multiprocessing.shared_memory.html#module-multiprocessing.shared_memory
@@ -41,6 +142,7 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
             camera_kwargs: dict = {},
             shared_memory_namespace: str = "camera",
             log_debug: bool = False,
+            cpu_core: Optional[int] = None,
     ):
         """Instantiates the publisher. Note that the publisher (and its process) will not start until start() is called.
 
@@ -48,10 +150,12 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
             camera_cls (type): The class e.g. Zed that this publisher will instantiate.
             camera_kwargs (dict, optional): The kwargs that will be passed to the camera_cls constructor.
             shared_memory_namespace (str, optional): The string that will be used to prefix the shared memory blocks that this class will create.
+            cpu_core (int, optional): The CPU core to pin the publishing thread to. Ideally, the receiver is pinned to a core that shares a cache with this one.
         """
 
-        # context = multiprocessing.get_context("spawn")  # Default "fork" leads to CUDA issues.
-        # Why it is a good idea in general to spawn: https://pythonspeed.com/articles/python-multiprocessing/
+        # Default "fork" leads to CUDA issues, so we start from the fork server, which never touches CUDA. This is as
+        # safe as "spawn", but does not need to import the Zed SDK for every publisher.
+        # Why it is a good idea in general not to fork: https://pythonspeed.com/articles/python-multiprocessing/
 
         super().__init__(daemon=True)
         self._shared_memory_namespace = shared_memory_namespace
@@ -59,18 +163,24 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
         self._camera_kwargs = camera_kwargs
         self._camera: Zed | None = None
         self.log_debug = log_debug
-        self.running_event = multiprocessing.Event()
-        self.shutdown_event = multiprocessing.Event()
+        self._cpu_core = cpu_core
+        self.running_event = _forkserver_context.Event()
+        self._running = False  # Only used inside the publisher process, see stop().
 
         # Declare these here so mypy doesn't complain.
-        self.rgb_left_shm: Optional[shared_memory.SharedMemory] = None
-        self.rgb_right_shm: Optional[shared_memory.SharedMemory] = None
-        self.rgb_shape_shm: Optional[shared_memory.SharedMemory] = None
-        self.timestamp_shm: Optional[shared_memory.SharedMemory] = None
-        self.intrinsics_shm: Optional[shared_memory.SharedMemory] = None
-        self.fps_shm: Optional[shared_memory.SharedMemory] = None
-        self.write_lock_shm: Optional[shared_memory.SharedMemory] = None
-        self.read_lock_shm: Optional[shared_memory.SharedMemory] = None
+        self._blocks: Dict[str, SharedMemoryBlock] = {}  # Created in setup, keyed by their name without namespace.
+        self._frame_ready_fd: Optional[int] = None
+        self.frame_lock_sem: Optional[posix_ipc.Semaphore] = None
+        self._camera_info_listener: Optional[Listener] = None
+
+        # The grab thread retrieves images into these matrices, which are allocated once and reused for every frame.
+        self._staging_mats: List[sl.Mat] = []
+        # Guards the handoff of frames from the grab thread to the main thread, see _grab_loop(). Created in setup,
+        # because this object is pickled to start the process, and locks can't be pickled.
+        self._frame_handoff: Optional[threading.Condition] = None
+        self._pending_frame: Optional[Tuple[int, int]] = None  # (staging mat index, timestamp) of the next frame.
+        self._converting_index: Optional[int] = None  # The staging mat that the main thread is reading.
+        self._grab_error: Optional[Exception] = None
 
         self.fps = None  # set in setup
         self.camera_period = None  # set in setup
@@ -90,21 +200,28 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
         terminated. This also frees up the names of the shared memory blocks so that they can be reused.
 
 
-        Five SharedMemory blocks are created, each block is prefixed with the namespace of the publisher. Three of these
-        are only written once, the other two are written continuously.
+        Three SharedMemory blocks are created, each block is prefixed with the namespace of the publisher. They are all
+        written continuously:
+        * rgb: four slots, one of which holds the most recently retrieved left and right images side by side (in BGR
+          order)
+        * published_frame: the timestamp of that image and the slot that holds it, packed into a single uint64
+        * reader_index: the two slots that the receiver is reading, written by the receiver
+
 
-        Constant blocks:
-        * intrinsics: the intrinsics matrix of the camera
-        * rgb_shape: the shape that rgb image array should be
-        * fps: the fps of the camera
+        To simplify access, we create numpy arrays that are backed by the shared memory blocks.
 
-        Blocks that are written continuously:
-        * rgb: the most recently retrieved image
-        * timestamp: the timestamp of that image
+        The rgb block is backed by huge pages if the system has reserved any, see huge_page_memory.py.
 
+        For synchronization, we create:
+        * frame_ready: an eventfd that is incremented once for every published frame. The receiver blocks on it
+          instead of polling the timestamp, and a single read tells it how many frames were published since the last
+          one, so it can tell when it has fallen behind.
+        * frame_lock: a named binary semaphore that is held while the publisher updates published_frame, or while the
+          receiver claims the slot in it, so that the publisher never picks a slot that the receiver is about to read
 
-        To simplify access, we create numpy arrays that are backed by the shared memory blocks for the rgb image and
-        the intrinsics matrix.
+        Information that never changes (the shape of the rgb images, the intrinsics matrix and the fps) is not put in
+        shared memory. Instead, it is sent once to every receiver that connects to the camera_info UNIX socket, along
+        with the frame_ready file descriptor (an eventfd has no name, so it can only be shared by passing it along).
         """
 
         # Instantiating a camera.
@@ -113,90 +230,233 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
         assert isinstance(self._camera, Zed)  # Check whether user passed a valid camera class
         logger.info(f"Successfully instantiated a {self._camera_cls.__name__} camera.")
 
-        rgb_left_name = f"{self._shared_memory_namespace}_{_RGB_LEFT_SHM_NAME}"
-        rgb_right_name = f"{self._shared_memory_namespace}_{_RGB_RIGHT_SHM_NAME}"
-        rgb_shape_name = f"{self._shared_memory_namespace}_{_RGB_SHAPE_SHM_NAME}"
-        timestamp_name = f"{self._shared_memory_namespace}_{_TIMESTAMP_SHM_NAME}"
-        intrinsics_name = f"{self._shared_memory_namespace}_{_INTRINSICS_SHM_NAME}"
-        fps_name = f"{self._shared_memory_namespace}_{_FPS_SHM_NAME}"
-        write_lock_name = f"{self._shared_memory_namespace}_{_WRITE_LOCK_SHM_NAME}"
-        read_lock_name = f"{self._shared_memory_namespace}_{_READ_LOCK_SHM_NAME}"
+        frame_lock_name = semaphore_name(self._shared_memory_namespace, _FRAME_LOCK_SEM_NAME)
 
         # Get the example arrays (this is the easiest way to initialize the shared memory blocks with the correct size).
         rgb = self._camera.get_rgb_image_as_int()  # We pass uint8 images as they consume 4x less memory
-        rgb_shape = np.array(rgb.shape)
+        height, width, channels = rgb.shape
+        rgb_slots = np.zeros((_N_RGB_SLOTS, height, 2 * width, channels), dtype=rgb.dtype)
         logger.info(f"Successfully retrieved an image of shape {rgb.shape} from the camera.")
 
-        timestamp = np.array([time.time()])
-        intrinsics = self._camera.intrinsics_matrix()
-
         self.fps = self._camera.fps
-        fps = np.array([self.fps], dtype=np.float64)
         self.camera_period = 1 / self.fps
 
-        write_lock = np.array([False], dtype=np.bool_)
-        read_lock = np.array([0], dtype=np.int_)
+        examples = {
+            _RGB_SHM_NAME: rgb_slots,
+            _PUBLISHED_FRAME_SHM_NAME: np.array([pack_published_frame(time.monotonic_ns(), 0)], dtype=np.uint64),
+            _READER_INDEX_SHM_NAME: np.full(_N_READER_SLOTS, -1, dtype=np.int64),
+        }
 
         # Create the shared memory blocks and numpy arrays that are backed by them.
         logger.info("Creating RGB shared memory blocks.")
-        self.rgb_left_shm, self.rgb_left_shm_array = shared_memory_block_like(rgb, rgb_left_name)
-        self.rgb_right_shm, self.rgb_right_shm_array = shared_memory_block_like(rgb, rgb_right_name)
-        self.rgb_shape_shm, self.rgb_shape_shm_array = shared_memory_block_like(rgb_shape, rgb_shape_name)
-        self.timestamp_shm, self.timestamp_shm_array = shared_memory_block_like(timestamp, timestamp_name)
-        self.intrinsics_shm, self.intrinsics_shm_array = shared_memory_block_like(intrinsics, intrinsics_name)
-        self.fps_shm, self.fps_shm_array = shared_memory_block_like(fps, fps_name)
-        self.write_lock_shm, self.write_lock_shm_array = shared_memory_block_like(write_lock, write_lock_name)
-        self.read_lock_shm, self.read_lock_shm_array = shared_memory_block_like(read_lock, read_lock_name)
+        arrays = {}
+        for name, example in examples.items():
+            block_like = huge_page_block_like if is_huge_page_block(name) else shared_memory_block_like
+            block_name = shared_memory_name(self._shared_memory_namespace, name)
+            self._blocks[name], arrays[name] = block_like(example, block_name)
+        self.rgb_shm_array = arrays[_RGB_SHM_NAME]
+        self.published_frame_shm_array = arrays[_PUBLISHED_FRAME_SHM_NAME]
+        self.reader_index_shm_array = arrays[_READER_INDEX_SHM_NAME]
 
         logger.info("Created RGB shared memory blocks.")
 
+        # Non-blocking, because the receiver always waits for it to become readable with select() first (which is how it
+        # can time out). Note that the receiver's copy shares this flag.
+        self._frame_ready_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self.frame_lock_sem = create_semaphore(frame_lock_name, initial_value=1)
+
+        self._staging_mats = [sl.Mat() for _ in range(_N_STAGING_MATS)]
+        self._frame_handoff = threading.Condition()
+
+        camera_info = {"rgb_shape": rgb.shape, "intrinsics": self._camera.intrinsics_matrix(), "fps": self.fps}
+        address = camera_info_address(self._shared_memory_namespace)
+        if os.path.exists(address):
+            os.unlink(address)  # Left behind by a publisher that crashed.
+        self._camera_info_listener = Listener(address, family="AF_UNIX")
+        threading.Thread(
+            target=self._serve_camera_info,
+            args=(self._camera_info_listener, camera_info, self._frame_ready_fd),
+            daemon=True,
+        ).start()
+
+    @staticmethod
+    def _serve_camera_info(listener: Listener, camera_info: dict, frame_ready_fd: int) -> None:
+        """Sends the camera information and the frame_ready file descriptor to every receiver that connects, until the
+        listener is closed."""
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                return
+            with connection:
+                connection.send(camera_info)
+                send_handle(connection, frame_ready_fd, None)  # The destination pid is only used on Windows.
+
     def stop(self) -> None:
-        self.shutdown_event.set()
+        """Asks the publisher process to stop, by sending it SIGTERM (which is what terminate() does on POSIX).
+
+        The process handles SIGTERM by clearing a plain boolean, which the main loop checks every frame. This is cheaper
+        than checking a multiprocessing.Event, which is a semaphore system call every frame."""
+        self.terminate()
+
+    def _on_stop(self, signum: int, frame: Optional[FrameType]) -> None:
+        self._running = False
+
+    def _free_slot_index(self) -> int:
+        """Returns a slot that holds neither the latest frame nor one of the frames that the receiver is reading.
+
+        The receiver only ever moves to the latest slot, which we never return, so reader_index can safely be read
+        without holding frame_lock."""
+        _, latest_index = unpack_published_frame(int(self.published_frame_shm_array[0]))
+        reader_index, previous_reader_index = self.reader_index_shm_array
+        for index in range(_N_RGB_SLOTS):
+            if index != latest_index and index != reader_index and index != previous_reader_index:
+                return index
+        raise RuntimeError("No free shared memory slot, this should never happen with four slots.")
+
+    def _grab_loop(self) -> None:
+        """Runs in the grab thread: grabs frames and retrieves them into a free staging matrix, then hands them off to
+        the main thread. This way, grabbing the next frame overlaps with publishing the previous one.
+
+        Instead of going through Zed._retrieve_rgb_image_as_int, which returns a strided BGRA -> RGB view that we would
+        then have to copy, we retrieve into our own matrices. Both views are retrieved with a single SIDE_BY_SIDE call,
+        into a single contiguous matrix.
+
+        At most one frame is pending: if the main thread has not taken it yet when the next frame is retrieved, it is
+        dropped. It would not be published anyway, as only the latest frame is kept in shared memory."""
+        camera = self._camera.camera
+        grab_images = self._camera._grab_images
+        staging_mats = self._staging_mats
+        frame_handoff = self._frame_handoff
+        monotonic_ns = time.monotonic_ns
+
+        try:
+            while self._running:
+                grab_images()
+                timestamp = monotonic_ns()
+
+                # Never retrieve into the matrix that the main thread is reading. Otherwise, keep the pending frame
+                # around while we retrieve, in case the main thread becomes free in the meantime.
+                with frame_handoff:
+                    unavailable_index = self._converting_index
+                    if unavailable_index is None and self._pending_frame is not None:
+                        unavailable_index = self._pending_frame[0]
+                    mat_index = 1 if unavailable_index == 0 else 0
+                    if self._pending_frame is not None and self._pending_frame[0] == mat_index:
+                        self._pending_frame = None
+
+                camera.retrieve_image(staging_mats[mat_index], sl.VIEW.SIDE_BY_SIDE)
+
+                with frame_handoff:
+                    self._pending_frame = (mat_index, timestamp)
+                    frame_handoff.notify()
+        except Exception as e:
+            self._grab_error = e
+
+    def _take_pending_frame(self, grab_thread: threading.Thread) -> Optional[Tuple[int, int]]:
+        """Waits for the grab thread to hand off a frame and marks its staging matrix as being read.
+
+        Returns:
+            The staging mat index and timestamp of the frame, or None if there was no frame within _HANDOFF_POLL_PERIOD.
+        """
+        with self._frame_handoff:
+            if self._pending_frame is None:
+                self._frame_handoff.wait(_HANDOFF_POLL_PERIOD)
+            if self._pending_frame is None:
+                if not grab_thread.is_alive() and self._running:
+                    raise RuntimeError("The grab thread stopped unexpectedly.") from self._grab_error
+                return None
+            frame = self._pending_frame
+            self._pending_frame = None
+            self._converting_index = frame[0]
+            return frame
+
+    def _convert_into_slot(self, mat_index: int, slot_index: int) -> None:
+        """Converts the given staging matrix and writes it into the given shared memory slot.
+
+        OpenCV writes the converted image directly into shared memory, so every image is copied only once (vectorized)
+        per frame, after it has been retrieved.
+
+        The images are stored as packed BGR: the alpha channel would add 33% to every byte we move, and BGR is the
+        channel order that the video writers expect, so the receiving end does not need to convert them again."""
+        image = self._staging_mats[mat_index].get_data()
+        cv2.cvtColor(image, cv2.COLOR_BGRA2BGR, dst=self.rgb_shm_array[slot_index])
+        with self._frame_handoff:
+            self._converting_index = None
 
     def run(self) -> None:
         """Main loop of the process, runs until the process is terminated.
 
-        Each iteration a new image is retrieved from the camera and copied to the shared memory block.
+        Frames are grabbed and retrieved by a separate grab thread (see _grab_loop). Each iteration, the main thread
+        takes the latest retrieved frame and writes it to the shared memory block. The Zed SDK and OpenCV release the
+        GIL while they work, so grabbing the next frame overlaps with publishing the previous one.
 
-        Note that we update timestamp after image data has been copied. This ensure that if the receiver sees a new
-        timestamp, it will also see the new image data. Theoretically it is possble that the recevier reads new image
-        data, but the timestamp is still old. I'm not sure whether this is a problem in practice.
+        Note that we publish the frame after image data has been copied. The timestamp and slot index are published
+        together with a single store (see pack_published_frame), so if the receiver sees a new timestamp, it also reads
+        the slot that holds the matching image data. The timestamp itself is taken right after the frame was grabbed.
 
-        # TODO: invesitgate whether a Lock is required when copying the image data to the shared memory block. Also
-        whether it is possible to do this without having to spawn all processes from a single Python script (e.g. to
-        pass the Lock object).
+        The image data is written into a free slot, which no receiver is reading, so we don't need to hold a lock while
+        writing. Only the update of published_frame happens while holding the frame_lock semaphore.
+        Afterwards, frame_ready is incremented to wake up receivers that are waiting for a new frame.
         """
 
+        # Install the handler first, so that stop() always leads to a clean shutdown.
+        self._running = True
+        signal.signal(signal.SIGTERM, self._on_stop)
+
         logger.info(f"{self.__class__.__name__} process started.")
+        limit_worker_threads()
+        try:
+            os.nice(-5)  # Reduce scheduling latency of the publisher. Lowering the niceness requires privileges.
+        except PermissionError:
+            logger.warning(f"Could not raise the priority of {self.__class__.__name__}, running at normal priority.")
         self._setup()
         assert isinstance(self._camera, RGBCamera)  # Just to make mypy happy, already checked in _setup()
         logger.info(f'{self.__class__.__name__} starting to publish to "{self._shared_memory_namespace}".')
 
+        # Look up everything the loop needs once, as locals, instead of through self.__dict__ every frame.
+        # self._running is the exception: the SIGTERM handler rebinds it.
+        take_pending_frame = self._take_pending_frame
+        free_slot_index = self._free_slot_index
+        convert_into_slot = self._convert_into_slot
+        published_frame_shm_array = self.published_frame_shm_array
+        frame_lock_sem = self.frame_lock_sem
+        frame_ready_fd = self._frame_ready_fd
+        eventfd_write = os.eventfd_write
+        set_running_event = self.running_event.set
+
+        grab_thread = threading.Thread(target=self._grab_loop, daemon=True)
+        grab_thread.start()
+
+        # Only pin the publishing thread, now that the Zed SDK's threads and the grab thread have been started (they
+        # would inherit the affinity). Otherwise they would all share one core, and grabbing would not overlap with
+        # publishing at all.
+        if self._cpu_core is not None:
+            pin_to_cpu_core(self._cpu_core)
+
         try:
-            while not self.shutdown_event.is_set():
-                self._camera._grab_images()
-
-                # Retrieve an image from the camera
-                image_left = self._camera._retrieve_rgb_image_as_int(view=StereoRGBDCamera.LEFT_RGB)
-                image_right = self._camera._retrieve_rgb_image_as_int(view=StereoRGBDCamera.RIGHT_RGB)
-
-                # Wait to write to the shared memory block until there are no active readers (or writers).
-                # (Normally we should be the only writer though.)
-                while self.read_lock_shm_array[0] > 0 and self.write_lock_shm_array[0]:
-                    time.sleep(0.00001)
-                self.write_lock_shm_array[0] = True
-
-                self.rgb_left_shm_array[:] = image_left[:]
-                self.rgb_right_shm_array[:] = image_right[:]
-                self.timestamp_shm_array[0] = time.time()
-                self.write_lock_shm_array[0] = False
-                self.running_event.set()
+            while self._running:
+                frame = take_pending_frame(grab_thread)
+                if frame is None:
+                    continue
+                mat_index, timestamp = frame
+
+                # Convert the images directly into shared memory.
+                write_index = free_slot_index()
+                convert_into_slot(mat_index, write_index)
+
+                with frame_lock_sem:
+                    published_frame_shm_array[0] = pack_published_frame(timestamp, write_index)
+                eventfd_write(frame_ready_fd, 1)
+                set_running_event()
         except Exception as e:
             logger.error(f"Error in {self.__class__.__name__}: {e}")
         finally:
+            self._running = False  # Also stops the grab thread, if we got here because of an error.
+            grab_thread.join(_GRAB_THREAD_JOIN_TIMEOUT)
+            del published_frame_shm_array  # It holds on to its block, which could then not be closed.
             self.unlink_shared_memory()
             logger.info(f"{self.__class__.__name__} process terminated.")
-        self.unlink_shared_memory()
 
     def unlink_shared_memory(self) -> None:
         """Cleanup of the SharedMemory as recommended by the docs:
@@ -206,56 +466,53 @@ class ZedPublisher(multiprocessing.context.SpawnProcess):
         watch -n 0.1 ls /dev/shm/
 
         However, I'm not sure how essential this actually is.
+
+        Safe to call more than once: resources are forgotten once they have been released. A resource that can't be
+        released does not keep the others from being released, otherwise they would be left behind for the next run.
         """
         print(f"Unlinking RGB shared memory blocks of {self.__class__.__name__}.")
 
-        if self.rgb_left_shm is not None:
-            self.rgb_left_shm.close()
-            self.rgb_left_shm.unlink()
-            self.rgb_left_shm = None
-
-        if self.rgb_right_shm is not None:
-            self.rgb_right_shm.close()
-            self.rgb_right_shm.unlink()
-            self.rgb_right_shm = None
-
-        if self.rgb_shape_shm is not None:
-            self.rgb_shape_shm.close()
-            self.rgb_shape_shm.unlink()
-            self.rgb_shape_shm = None
-
-        if self.timestamp_shm is not None:
-            self.timestamp_shm.close()
-            self.timestamp_shm.unlink()
-            self.timestamp_shm = None
-
-        if self.intrinsics_shm is not None:
-            self.intrinsics_shm.close()
-            self.intrinsics_shm.unlink()
-            self.intrinsics_shm = None
-
-        if self.fps_shm is not None:
-            self.fps_shm.close()
-            self.fps_shm.unlink()
-            self.fps_shm = None
-
-        if self.write_lock_shm is not None:
-            self.write_lock_shm.close()
-            self.write_lock_shm.unlink()
-            self.write_lock_shm = None
-
-        if self.read_lock_shm is not None:
-            self.read_lock_shm.close()
-            self.read_lock_shm.unlink()
-            self.read_lock_shm = None
-
-    def __del__(self) -> None:
-        self.unlink_shared_memory()
+        # Drop our numpy arrays first, as the blocks can't be closed while arrays on them are alive.
+        self.rgb_shm_array = None
+        self.published_frame_shm_array = None
+        self.reader_index_shm_array = None
+
+        for name, shm in self._blocks.items():
+            close_block(name, shm)
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._blocks.clear()
+
+        if self._frame_ready_fd is not None:
+            try:
+                os.close(self._frame_ready_fd)
+            except OSError as e:
+                logger.warning(f"Could not close the frame_ready eventfd: {e}")
+            self._frame_ready_fd = None
+
+        if self.frame_lock_sem is not None:
+            try:
+                self.frame_lock_sem.unlink()
+                self.frame_lock_sem.close()
+            except posix_ipc.Error as e:
+                logger.warning(f"Could not remove the frame_lock semaphore: {e}")
+            self.frame_lock_sem = None
+
+        if self._camera_info_listener is not None:
+            try:
+                self._camera_info_listener.close()  # This also removes the socket file.
+            except OSError as e:
+                logger.warning(f"Could not close the camera_info socket: {e}")
+            self._camera_info_listener = None
 
 
 class ZedReceiver(RGBCamera):
     """Implements the RGBD camera interface for a camera that is running in a different process and shares its data using shared memory blocks.
     To be used with the Publisher class.
+
+    Only one receiver per namespace is supported: the publisher keeps track of a single slot that is being read.
     """
 
     def __init__(
@@ -265,26 +522,17 @@ class ZedReceiver(RGBCamera):
         super().__init__()
 
         self._shared_memory_namespace = shared_memory_namespace
-        rgb_left_name = f"{self._shared_memory_namespace}_{_RGB_LEFT_SHM_NAME}"
-        rgb_right_name = f"{self._shared_memory_namespace}_{_RGB_RIGHT_SHM_NAME}"
-        rgb_shape_name = f"{self._shared_memory_namespace}_{_RGB_SHAPE_SHM_NAME}"
-        timestamp_name = f"{self._shared_memory_namespace}_{_TIMESTAMP_SHM_NAME}"
-        intrinsics_name = f"{self._shared_memory_namespace}_{_INTRINSICS_SHM_NAME}"
-        fps_name = f"{self._shared_memory_namespace}_{_FPS_SHM_NAME}"
-        write_lock_name = f"{self._shared_memory_namespace}_{_WRITE_LOCK_SHM_NAME}"
-        read_lock_name = f"{self._shared_memory_namespace}_{_READ_LOCK_SHM_NAME}"
+        frame_lock_name = semaphore_name(self._shared_memory_namespace, _FRAME_LOCK_SEM_NAME)
 
         # Attach to existing shared memory blocks. Retry a few times to give the publisher time to start up (opening
         # connection to a camera can take a while).
 
-        self.rgb_left_shm = shared_memory.SharedMemory(name=rgb_left_name)
-        self.rgb_right_shm = shared_memory.SharedMemory(name=rgb_right_name)
-        self.rgb_shape_shm = shared_memory.SharedMemory(name=rgb_shape_name)
-        self.timestamp_shm = shared_memory.SharedMemory(name=timestamp_name)
-        self.intrinsics_shm = shared_memory.SharedMemory(name=intrinsics_name)
-        self.fps_shm = shared_memory.SharedMemory(name=fps_name)
-        self.write_lock_shm = shared_memory.SharedMemory(name=write_lock_name)
-        self.read_lock_shm = shared_memory.SharedMemory(name=read_lock_name)
+        self._blocks: Dict[str, SharedMemoryBlock] = {}
+        for name in _SHM_NAMES:
+            attach = attach_huge_page_block if is_huge_page_block(name) else shared_memory.SharedMemory
+            self._blocks[name] = attach(shared_memory_name(self._shared_memory_namespace, name))
+        self.frame_lock_sem = posix_ipc.Semaphore(frame_lock_name)
+        self._frame_ready_fd: Optional[int] = None  # Received along with the camera information below.
 
         logger.info(f'SharedMemory namespace "{self._shared_memory_namespace}" found.')
 
@@ -294,62 +542,95 @@ class ZedReceiver(RGBCamera):
         # Concretely, the problem was that once any MultiprocessRGBReceiver object was destroyed, all further access to
         # the shared memory blocks would fail with a FileNotFoundError.
         # We also ignore mypy telling us to use .name instead of ._name, because the latter is used in the registration.
-        resource_tracker.unregister(self.rgb_left_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.rgb_right_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.rgb_shape_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.intrinsics_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.timestamp_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.fps_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.write_lock_shm._name, "shared_memory")  # type: ignore[attr-defined]
-        resource_tracker.unregister(self.read_lock_shm._name, "shared_memory")  # type: ignore[attr-defined]
-
-        # Timestamp and intrinsics are the same shape for all images, so I decided that we could hardcode their shape.
-        # However, images come in many shapes, which I also decided to pass via shared memory. (Previously, I required
-        # the image resolution to be passed to this class' constructor, but that was inconvenient to keep in sync
-        # between publisher and receiver scripts.)
-        # Create numpy arrays that are backed by the shared memory blocks
-        self.rgb_shape_shm_array: np.ndarray = np.ndarray((3,), dtype=np.int64, buffer=self.rgb_shape_shm.buf)
-        self.intrinsics_shm_array: np.ndarray = np.ndarray((3, 3), dtype=np.float64, buffer=self.intrinsics_shm.buf)
-        self.timestamp_shm_array: np.ndarray = np.ndarray((1,), dtype=np.float64, buffer=self.timestamp_shm.buf)
-        self.fps_shm_array: np.ndarray = np.ndarray((1,), dtype=np.float64, buffer=self.fps_shm.buf)
-        self.write_lock_shm_array: np.ndarray = np.ndarray((1,), dtype=np.bool_, buffer=self.write_lock_shm.buf)
-        self.read_lock_shm_array: np.ndarray = np.ndarray((1,), dtype=np.int_, buffer=self.read_lock_shm.buf)
+        # Blocks that are backed by huge pages are not registered with the resource tracker.
+        for shm in self._blocks.values():
+            if isinstance(shm, shared_memory.SharedMemory):
+                resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+
+        # Images come in many shapes, so the publisher sends the shape along with the other constant camera information.
+        # (Previously, I required the image resolution to be passed to this class' constructor, but that was
+        # inconvenient to keep in sync between publisher and receiver scripts.)
+        with Client(camera_info_address(self._shared_memory_namespace), family="AF_UNIX") as connection:
+            camera_info = connection.recv()
+            self._frame_ready_fd = recv_handle(connection)
+        self.fps = camera_info["fps"]
+        self._intrinsics_matrix = camera_info["intrinsics"]
+        self._rgb_shape = camera_info["rgb_shape"]
+        # The resolution never changes during a session, so we build it once instead of on every access.
+        self._resolution: CameraResolutionType = (int(self._rgb_shape[1]), int(self._rgb_shape[0]))
 
-        self.fps = self.fps_shm_array[0]
+        # Create numpy arrays that are backed by the shared memory blocks
+        published_frame_buffer = self._blocks[_PUBLISHED_FRAME_SHM_NAME].buf
+        reader_index_buffer = self._blocks[_READER_INDEX_SHM_NAME].buf
+        self.published_frame_shm_array: np.ndarray = np.ndarray((1,), dtype=np.uint64, buffer=published_frame_buffer)
+        self.reader_index_shm_array: np.ndarray = np.ndarray(
+            (_N_READER_SLOTS,), dtype=np.int64, buffer=reader_index_buffer
+        )
+        height, width, channels = self._rgb_shape
+        rgb_slots_shape = (_N_RGB_SLOTS, height, 2 * width, channels)
+        rgb_buffer = self._blocks[_RGB_SHM_NAME].buf
+        self.rgb_shm_array: np.ndarray = np.ndarray(rgb_slots_shape, dtype=np.uint8, buffer=rgb_buffer)
+        # Images are returned as views on this array, which must never be written to from this side.
+        self.rgb_shm_array.setflags(write=False)
+        # Zero-copy views on the left and right halves of every slot.
+        self.rgb_left_shm_array: np.ndarray = self.rgb_shm_array[:, :, :width]
+        self.rgb_right_shm_array: np.ndarray = self.rgb_shm_array[:, :, width:]
+        # The (left, right) views of each slot, made once so that retrieving an image does not create new views. The
+        # RGB views just reverse the channel axis of the BGR views, which does not copy either.
+        self._bgr_slot_views = [
+            (self.rgb_left_shm_array[index], self.rgb_right_shm_array[index]) for index in range(_N_RGB_SLOTS)
+        ]
+        self._rgb_slot_views = [(left[..., ::-1], right[..., ::-1]) for left, right in self._bgr_slot_views]
+
+        self.previous_timestamp = time.monotonic_ns()
+        self.retrieved_timestamp = 0  # The timestamp of the images that were retrieved last.
+
+        # The publisher has been counting frames since it started, so we drop that stale count.
+        self._read_frame_ready()
+
+    def get_current_timestamp(self) -> int:
+        """Timestamp of the image that is currently in the shared memory block, in nanoseconds.
+
+        The timestamp comes from time.monotonic_ns(), so it can be compared between processes and is not affected by
+        changes of the system clock, but it is not a wall clock time.
+
+        A new frame can be published before the images are retrieved, so this timestamp does not necessarily belong to
+        the images that are retrieved next. Use retrieved_timestamp after retrieving for the timestamp of those images.
+        """
+        timestamp, _ = unpack_published_frame(int(self.published_frame_shm_array[0]))
+        return timestamp
 
-        # The shape of the image is not known in advance, so we need to retrieve it from the shared memory block.
-        rgb_shape = tuple(self.rgb_shape_shm_array[:])
-        self.rgb_left_shm_array: np.ndarray = np.ndarray(rgb_shape, dtype=np.uint8, buffer=self.rgb_left_shm.buf)
-        self.rgb_right_shm_array: np.ndarray = np.ndarray(rgb_shape, dtype=np.uint8, buffer=self.rgb_right_shm.buf)
+    @property
+    def resolution(self) -> CameraResolutionType:
+        """The resolution of the camera, in pixels."""
+        return self._resolution
 
-        # Preallocate the buffer array to avoid reallocation at each retrieve.
-        self.rgb_left_buffer_array: np.ndarray = np.ndarray(rgb_shape, dtype=np.uint8)
-        self.rgb_right_buffer_array: np.ndarray = np.ndarray(rgb_shape, dtype=np.uint8)
+    def _read_frame_ready(self) -> int:
+        """Resets the frame_ready counter without blocking and returns the number of frames published since the last
+        read."""
+        try:
+            return os.eventfd_read(self._frame_ready_fd)
+        except BlockingIOError:
+            return 0
 
-        self.previous_timestamp = time.time()
+    def wait_for_frame(self, timeout: Optional[float] = None) -> int:
+        """Blocks until the publisher has published a new frame.
 
-    def get_current_timestamp(self) -> float:
-        """Timestamp of the image that is currently in the shared memory block.
+        Args:
+            timeout: The maximum time to wait, in seconds. None means wait forever.
 
-        Warning: our current implementation, in theory the image and the timestamp could be out of sync when reading.
-        Having atomic read/writes of both the image and timestap (a la ROS) would solve this.
+        Returns:
+            The number of frames that were published since the previous call, 0 if none were published within the
+            timeout. More than 1 means that we fell behind: only the latest of those frames is still in shared memory.
         """
-        return self.timestamp_shm_array[0]
-
-    @property
-    def resolution(self) -> CameraResolutionType:
-        """The resolution of the camera, in pixels."""
-        shape_array = [int(x) for x in self.rgb_shape_shm_array[:2]]
-        return (shape_array[1], shape_array[0])
+        readable, _, _ = select.select([self._frame_ready_fd], [], [], timeout)
+        if not readable:
+            return 0
+        return self._read_frame_ready()
 
     def _grab_images(self) -> None:
-        # logger.info(
-        #     f"Current timestamp: {self.get_current_timestamp():.3f}, previous timestamp: {self.previous_timestamp:.3f}"
-        # )
-        while not self.get_current_timestamp() > self.previous_timestamp:
-            time.sleep(0.0001)
+        self.wait_for_frame()
         self.previous_timestamp = self.get_current_timestamp()
-        # logger.debug(f"Updating timestamp: {self.previous_timestamp:.3f}")
 
     def _retrieve_rgb_image(self) -> Tuple[NumpyFloatImageType, NumpyFloatImageType]:
         # No need to check writing lock here because the _retrieve_rgb_image_as_int method does it.
@@ -359,53 +640,63 @@ class ZedReceiver(RGBCamera):
         return image_left, image_right
 
     def _retrieve_rgb_image_as_int(self) -> Tuple[NumpyIntImageType, NumpyIntImageType]:
-        while self.write_lock_shm_array[0]:
-            time.sleep(0.00001)
-        self.read_lock_shm_array[0] += 1
-#         logger.info(f"{self.rgb_left_shm_array.mean()}, {self.rgb_right_shm_array.mean()}")
-        self.rgb_left_buffer_array[:] = self.rgb_left_shm_array[:]
-        self.rgb_right_buffer_array[:] = self.rgb_right_shm_array[:]
-        self.read_lock_shm_array[0] -= 1
-        return self.rgb_left_buffer_array, self.rgb_right_buffer_array
+        """The images are not copied: they are read-only views on the shared memory slot that holds the latest frame.
+        They remain valid during the next call of this method, but not after that, because then the slot is released
+        and the publisher may overwrite it. Copy them if you need them for longer.
+
+        The publisher stores the images in BGR order, so these views step through the channels in reverse. Use
+        retrieve_bgr_images() if you need BGR (e.g. for OpenCV) or contiguous images."""
+        return self._rgb_slot_views[self._claim_latest_slot()]
+
+    def retrieve_bgr_images(self) -> Tuple[NumpyIntImageType, NumpyIntImageType]:
+        """Like _retrieve_rgb_image_as_int, but returns the left and right images in BGR order, which is how the
+        publisher stores them and what the video writers expect. The same view lifetime applies."""
+        return self._bgr_slot_views[self._claim_latest_slot()]
+
+    def _claim_latest_slot(self) -> int:
+        """Claims the slot that holds the latest frame and returns its index. We keep holding the slot that was claimed
+        before, so the previously retrieved images remain valid, but the slot claimed before that is released.
+
+        retrieved_timestamp is set to the timestamp that was published along with the claimed slot, so it always
+        belongs to the retrieved images."""
+        published_frame_shm_array = self.published_frame_shm_array
+        reader_index_shm_array = self.reader_index_shm_array
+
+        # Claim the latest slot. The publisher will not write to it until we have claimed two other ones.
+        with self.frame_lock_sem:
+            timestamp, index = unpack_published_frame(int(published_frame_shm_array[0]))
+            reader_index_shm_array[1] = reader_index_shm_array[0]
+            reader_index_shm_array[0] = index
+        self.retrieved_timestamp = timestamp
+        return index
 
     def intrinsics_matrix(self) -> CameraIntrinsicsMatrixType:
-        return self.intrinsics_shm_array
+        return self._intrinsics_matrix
 
     def _close_shared_memory(self) -> None:
         """Signal that the shared memory blocks are no longer needed from this process."""
         print(f"Closing RGB shared memory blocks of {self.__class__.__name__}.")
 
-        if self.rgb_left_shm is not None:
-            self.rgb_left_shm.close()
-            self.rgb_left_shm = None  # type: ignore
-
-        if self.rgb_right_shm is not None:
-            self.rgb_right_shm.close()
-            self.rgb_right_shm = None  # type: ignore
-
-        if self.rgb_shape_shm is not None:
-            self.rgb_shape_shm.close()
-            self.rgb_shape_shm = None  # type: ignore
-
-        if self.timestamp_shm is not None:
-            self.timestamp_shm.close()
-            self.timestamp_shm = None  # type: ignore
-
-        if self.intrinsics_shm is not None:
-            self.intrinsics_shm.close()
-            self.intrinsics_shm = None  # type: ignore
-
-        if self.fps_shm is not None:
-            self.fps_shm.close()
-            self.fps_shm = None  # type: ignore
-
-        if self.write_lock_shm is not None:
-            self.write_lock_shm.close()
-            self.write_lock_shm = None  # type: ignore
-
-        if self.read_lock_shm is not None:
-            self.read_lock_shm.close()
-            self.read_lock_shm = None  # type: ignore
+        # Drop our numpy arrays and views first, as the blocks can't be closed while arrays on them are alive.
+        self.published_frame_shm_array = None  # type: ignore
+        self.reader_index_shm_array = None  # type: ignore
+        self.rgb_shm_array = None  # type: ignore
+        self.rgb_left_shm_array = None  # type: ignore
+        self.rgb_right_shm_array = None  # type: ignore
+        self._bgr_slot_views = []
+        self._rgb_slot_views = []
+
+        for name, shm in self._blocks.items():
+            close_block(name, shm)
+        self._blocks.clear()
+
+        if self._frame_ready_fd is not None:
+            os.close(self._frame_ready_fd)
+            self._frame_ready_fd = None
+
+        if self.frame_lock_sem is not None:
+            self.frame_lock_sem.close()
+            self.frame_lock_sem = None  # type: ignore
 
     def __del__(self) -> None:
         self._close_shared_memory()
\ No newline at end of file
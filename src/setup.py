@@ -16,6 +16,7 @@ setuptools.setup(
         "airo-camera-toolkit @ git+https://github.com/airo-ugent/airo-mono@e20960e69c04033247ea5098f4c9c0ca577ab659#subdirectory=airo-camera-toolkit",
         "airo-dataset-tools @ git+https://github.com/airo-ugent/airo-mono@e20960e69c04033247ea5098f4c9c0ca577ab659#subdirectory=airo-dataset-tools",
         "loguru==0.7.2",
+        "posix_ipc",
 
     ],
     packages=find_packages(),